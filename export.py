@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+"""
+Export every search match for a query, joined with conversation metadata, to CSV, JSONL or Parquet.
+Rows are hydrated and written a page at a time, so memory use doesn't grow with the size of the export.
+
+python export.py "affordable housing" housing.parquet --min-similarity 0.5
+python export.py "affordable housing" - --max-results 50000 --format jsonl > housing.jsonl
+"""
+
+import argparse
+import os
+import sys
+
+import util
+import vectorize
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("query", help="Search query")
+    parser.add_argument("output", help='Output file, or "-" for stdout')
+    parser.add_argument("--corpus", default=list(util.CORPORA.keys())[0])
+    parser.add_argument(
+        "--format",
+        choices=util.EXPORT_FORMATS,
+        help="Output format (defaults to the output file's extension, or csv)",
+    )
+    parser.add_argument(
+        "--min-similarity",
+        type=float,
+        help="Export every match with at least this cosine similarity to the query",
+    )
+    parser.add_argument(
+        "--max-results",
+        type=int,
+        help="Export at most this many matches (default 10000 without --min-similarity)",
+    )
+    parser.add_argument("--page-size", type=int, default=util.EXPORT_PAGE_SIZE)
+    args = parser.parse_args()
+
+    fmt = args.format
+    if fmt is None:
+        fmt = os.path.splitext(args.output)[1].lstrip(".").lower()
+        if fmt not in util.EXPORT_FORMATS:
+            fmt = "csv"
+    max_results = args.max_results
+    if max_results is None and args.min_similarity is None:
+        max_results = 10000
+
+    data = util.load_data(corpus=args.corpus)
+    encode = vectorize.get_encoder(use_local_embeddings=True)
+    ids, similarities = util.search_all(
+        args.query,
+        data,
+        encode,
+        min_similarity=args.min_similarity,
+        max_results=max_results,
+    )
+    print("Exporting %s matches..." % (len(ids)), file=sys.stderr)
+    columns = util.export_columns(data)
+    pages = util.iter_export_rows(ids, similarities, data, page_size=args.page_size)
+    if args.output == "-":
+        num_rows = util.write_export(pages, sys.stdout.buffer, columns, fmt=fmt)
+    else:
+        with open(args.output, "wb") as fs_out:
+            num_rows = util.write_export(pages, fs_out, columns, fmt=fmt)
+    print("Wrote %s rows." % (num_rows), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
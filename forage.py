@@ -4,10 +4,12 @@ Forage streamlit app.
 streamlit run forage.py
 """
 
+import hashlib
 import json
 import streamlit as st
 import faiss
 import gpt_lib
+import scheduler
 import sys
 import vectorize
 import yaml
@@ -42,20 +44,70 @@ def load_data(use_local_embeddings=True):
 
 
 @st.cache_data(persist=True)
-def run_rag_query(user_input, results, model, input_scope):
+def cached_rag_query(user_input, results, model, input_scope):
     return util.run_rag_query(user_input, results, model, input_scope)
 
 
+@st.cache_resource
+def cached_analysis_keys():
+    """Keys of the analyses this process knows are in cached_rag_query's cache."""
+    return set()
+
+
+def run_rag_query(user_input, results, model, input_scope, on_wait=None):
+    # Only cache misses call the LLM, so only they wait for an LLM slot.  The slot is taken
+    # outside the cached function: on_wait writes to the page, and Streamlit would otherwise
+    # record those writes as part of the cached result and fail to replay them.
+    key = hashlib.sha256(
+        json.dumps([user_input, results, model, input_scope], sort_keys=True).encode()
+    ).hexdigest()
+    if key in cached_analysis_keys():
+        return cached_rag_query(user_input, results, model, input_scope)
+    with scheduler.llm_slot(on_wait=on_wait):
+        analysis = cached_rag_query(user_input, results, model, input_scope)
+    cached_analysis_keys().add(key)
+    return analysis
+
+
+def queue_notifier(placeholder):
+    """Make an on_wait callback for the scheduler that shows the user their place in line."""
+
+    def on_wait(position):
+        placeholder.info("The server is busy.  You are number %d in line." % (position))
+
+    return on_wait
+
+
+SERVER_BUSY_MESSAGE = "The server is too busy right now.  Please try again in a minute."
+
+
+def show_server_busy():
+    st.error(SERVER_BUSY_MESSAGE)
+    st.stop()
+
+
 def get_help_text(res):
+    s = ""
     if "speaker_intro" in res and res["speaker_intro"]:
-        return res["speaker_intro"]
+        s = res["speaker_intro"] + "\n"
     elif "prev_speaker_name" in res and res["prev_speaker_name"]:
         s = "Previous speaker: %s\n" % (res["prev_speaker_name"])
         s += "Previous speaker turn: %s\n" % (res["prev_content"])
         s += "Next speaker: %s\n" % (res["next_speaker_name"])
         s += "Next speaker turn: %s\n" % (res["next_content"])
-        return s
-    return None
+    # Remarks folded into this one by "Collapse near-duplicate remarks"
+    for key, heading in [
+        ("duplicates", "Similar remarks"),
+        ("more_from_conversation", "More from this conversation"),
+    ]:
+        if res.get(key):
+            s += "\n%s:\n" % (heading)
+            for other in res[key]:
+                s += "- %s: %s\n" % (
+                    util.display_speaker_name(other["speaker_name"]),
+                    other["content"],
+                )
+    return s or None
 
 
 def render_results(
@@ -95,6 +147,51 @@ def render_results(
                 st.markdown(render_result(res, data), help=get_help_text(res))
 
 
+def load_more_results():
+    """Button callback: append the next page of the current search to the session's results."""
+    paged = st.session_state.get("paged_search")
+    if paged is None or not paged["cursor"]:
+        return
+    st.session_state["show_more_results"] = True
+    # Elements written from a callback appear at the top of the page
+    queue_notice = st.empty()
+    try:
+        with scheduler.search_slot(on_wait=queue_notifier(queue_notice)):
+            page = util.fetch_next_page(paged["cursor"], load_data()[paged["corpus"]])
+    except scheduler.QueueFullError:
+        # Leave the results as they are, and say why on the rerun
+        st.session_state["load_more_busy"] = True
+        return
+    finally:
+        queue_notice.empty()
+    if page is None:
+        paged["cursor"] = None
+        paged["expired"] = True
+    else:
+        results, paged["cursor"] = page
+        paged["results"] = paged["results"] + results
+
+
+def render_load_more_button():
+    st.button("Load more results", on_click=load_more_results, key="load-more")
+
+
+def render_conversations(conversations, data):
+    with st.expander("Most relevant conversations"):
+        for i, (conversation_id, similarity) in enumerate(conversations):
+            conv_info = data["conversations"][conversation_id]
+            st.markdown(
+                "%d. [%s](%s), %s *(similarity %.2f)*"
+                % (
+                    i + 1,
+                    conv_info["title"],
+                    util.playback_link(conversation_id, 0.0),
+                    conv_info["start_time"][:10],
+                    similarity,
+                )
+            )
+
+
 def main():
     st.set_page_config(layout="wide", page_title="Forage")
     params = st.query_params
@@ -192,6 +289,18 @@ def main():
                         index=1,
                     )
                     model = dict(MODELS)[analysis_model]
+            collapse_duplicates = st.checkbox(
+                "Collapse near-duplicate remarks",
+                value=False,
+                help="Fold near-identical speaker turns together and limit how many come from any one conversation, so the analysis sees more distinct remarks.",
+            )
+            conversations_first = st.checkbox(
+                "Search the most relevant conversations first",
+                value=False,
+                disabled="conversation_index" not in corpus_to_data[corpus],
+                help="Pick the %d conversations closest to your subject, then search only their speaker turns.  Faster on very large data sets, and lists the conversations it picked."
+                % (util.CONVERSATION_SEARCH_SIZE),
+            )
 
         col1, col2 = st.columns(2)
         with col1:
@@ -238,13 +347,36 @@ def main():
             }
             with open("log.jsonl", "a") as fs_log:
                 print(json.dumps(log_line), file=fs_log)
+            queue_notice = st.empty()
             with st.spinner("Fetching results..."):
-                results = util.run_query(subject, data, encode, input_scope, corpus)
+                conversations = cursor = None
+                try:
+                    with scheduler.search_slot(on_wait=queue_notifier(queue_notice)):
+                        if conversations_first and "conversation_index" in data:
+                            results, conversations = util.run_conversation_query(
+                                subject, data, encode, input_scope, corpus
+                            )
+                        elif input_scope == "search_only" and not collapse_duplicates:
+                            # Only plain search results can be extended with "Load more"
+                            results, cursor = util.run_paged_query(
+                                subject, data, encode, input_scope, corpus
+                            )
+                        else:
+                            results = util.run_query(
+                                subject, data, encode, input_scope, corpus
+                            )
+                        if collapse_duplicates:
+                            results = util.diversify_results(results, data)
+                except scheduler.QueueFullError:
+                    show_server_busy()
+            queue_notice.empty()
             if input_scope == "search_only":
                 raw_results_col = st.container()
             else:
                 raw_results_col, analysis_col = st.columns(2)
             with raw_results_col:
+                if conversations:
+                    render_conversations(conversations, data)
                 st.write('<a name="results"></a>', unsafe_allow_html=True)
                 st.header("Search results")
                 results_container = st.empty()
@@ -255,15 +387,31 @@ def main():
                     show_download_button=(input_scope == "search_only"),
                     corpus=corpus,
                 )
+                if cursor:
+                    st.session_state["paged_search"] = {
+                        "corpus": corpus,
+                        "results": results,
+                        "cursor": cursor,
+                    }
+                    render_load_more_button()
             if input_scope != "search_only":
                 with analysis_col:
                     st.write('<a name="analysis"></a>', unsafe_allow_html=True)
                     st.header("Analysis")
                     st.write('<a name="spacer"></a>', unsafe_allow_html=True)
+                    queue_notice = st.empty()
                     with st.spinner():
-                        analysis = run_rag_query(
-                            user_input, results, model, input_scope
-                        )
+                        try:
+                            analysis = run_rag_query(
+                                user_input,
+                                results,
+                                model,
+                                input_scope,
+                                on_wait=queue_notifier(queue_notice),
+                            )
+                        except scheduler.QueueFullError:
+                            show_server_busy()
+                        queue_notice.empty()
                         analysis_markdown, citation_counts = util.analyze_citations(
                             analysis, results, corpus=corpus
                         )
@@ -281,16 +429,40 @@ def main():
             with open("full_log.jsonl", "a") as fs_log:
                 log_line["search_results"] = results
                 log_line["analysis_output"] = analysis
+                log_line["scheduler"] = scheduler.get_metrics()
                 print(json.dumps(log_line), file=fs_log)
             st.query_params.corpus = corpus
             st.query_params.objective = objective
             st.query_params.subject = subject
+        elif st.session_state.pop("show_more_results", False):
+            paged = st.session_state["paged_search"]
+            data = corpus_to_data[paged["corpus"]]
+            st.write('<a name="results"></a>', unsafe_allow_html=True)
+            st.header("Search results")
+            results_container = st.empty()
+            render_results(
+                paged["results"],
+                results_container,
+                data,
+                show_download_button=True,
+                corpus=paged["corpus"],
+            )
+            if st.session_state.pop("load_more_busy", False):
+                st.error(SERVER_BUSY_MESSAGE)
+            if paged.get("expired"):
+                st.warning("These search results have expired.  Please search again.")
+            elif paged["cursor"]:
+                render_load_more_button()
 
     elif authentication_status == False:
         st.error("Username/password is incorrect")
     elif authentication_status == None:
         st.warning("Please enter your username and password")
 
+    with st.expander("Server load"):
+        st.caption("Requests running and waiting, and recent wait times in seconds")
+        st.json(scheduler.get_metrics())
+
     st.write(
         "[Terms](https://docs.google.com/document/d/1A7ZjyVL39JTE0c3HbW6xixT76I79kqh-G6PsQeI6JAs/edit?usp=sharing), [Feedback](https://docs.google.com/forms/d/e/1FAIpQLScWLVZNiE-KNwR-3fFHGHpsmZIvHWwCQhvXba20HwaclJz6qQ/viewform)"
     )
@@ -311,6 +483,13 @@ def render_result(res, data):
         link,
         conv_info["start_time"][:10],
     )
+    # The folded remarks themselves are shown in the help tooltip (see get_help_text)
+    if res.get("duplicates"):
+        md += " *(+%d similar remarks)*" % (len(res["duplicates"]))
+    if res.get("more_from_conversation"):
+        md += " *(+%d more from this conversation)*" % (
+            len(res["more_from_conversation"])
+        )
     md += " [&uarr;](#analysis) "  # up arrow to go back to analysis
 
     return md
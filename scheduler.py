@@ -0,0 +1,135 @@
+"""
+Admission control for work shared by all Streamlit sessions.
+
+CPU-bound searches (query encoding plus FAISS) are capped at SEARCH_CONCURRENCY, and each one sets
+FAISS and torch to THREADS_PER_SEARCH threads, its share of the cores, so concurrent sessions never
+use more threads than there are cores.  Fewer concurrent searches means more threads for each one;
+set FORAGE_SEARCH_CONCURRENCY to trade one for the other.  LLM calls are mostly waiting on the
+network and get their own limit, FORAGE_LLM_CONCURRENCY.  Requests beyond a limit wait in a FIFO
+queue; callers can pass on_wait to show queue position.
+"""
+
+from collections import deque
+from contextlib import contextmanager
+import os
+import threading
+import time
+
+import faiss
+
+try:
+    import torch
+except ImportError:  # Only needed for local embeddings
+    torch = None
+
+CPU_COUNT = os.cpu_count() or 1
+SEARCH_CONCURRENCY = int(
+    os.environ.get("FORAGE_SEARCH_CONCURRENCY", max(1, CPU_COUNT // 2))
+)
+THREADS_PER_SEARCH = max(1, CPU_COUNT // SEARCH_CONCURRENCY)
+LLM_CONCURRENCY = int(os.environ.get("FORAGE_LLM_CONCURRENCY", 4))
+# Requests beyond this many waiting are turned away rather than queued
+MAX_QUEUE_DEPTH = 50
+# How many recent wait times to keep for metrics
+METRICS_WINDOW = 1000
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class _Queue:
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.cond = threading.Condition()
+        self.waiting = deque()
+        self.running = 0
+        self.completed = 0
+        self.wait_times = deque(maxlen=METRICS_WINDOW)
+
+    @contextmanager
+    def slot(self, on_wait=None):
+        """Wait for a free slot, calling on_wait(position) whenever our place in line changes."""
+        ticket = object()
+        start = time.time()
+        with self.cond:
+            if len(self.waiting) >= MAX_QUEUE_DEPTH:
+                raise QueueFullError("Too many %s requests waiting" % (self.name))
+            self.waiting.append(ticket)
+        reported = None
+        try:
+            while True:
+                with self.cond:
+                    if self.waiting[0] is ticket and self.running < self.limit:
+                        self.waiting.popleft()
+                        self.running += 1
+                        self.wait_times.append(time.time() - start)
+                        # The next in line may be able to start too
+                        self.cond.notify_all()
+                        break
+                    position = self.waiting.index(ticket) + 1
+                    if position == reported:
+                        self.cond.wait(timeout=1.0)
+                        continue
+                reported = position
+                if on_wait:
+                    on_wait(position)
+        except BaseException:
+            # e.g. Streamlit stopping the script because the user navigated away
+            with self.cond:
+                if ticket in self.waiting:
+                    self.waiting.remove(ticket)
+                self.cond.notify_all()
+            raise
+
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.completed += 1
+                self.cond.notify_all()
+
+    def metrics(self):
+        with self.cond:
+            wait_times = sorted(self.wait_times)
+            m = {
+                "limit": self.limit,
+                "running": self.running,
+                "queue_depth": len(self.waiting),
+                "completed": self.completed,
+            }
+        if wait_times:
+            m["mean_wait_seconds"] = sum(wait_times) / len(wait_times)
+            m["p50_wait_seconds"] = wait_times[len(wait_times) // 2]
+            m["p99_wait_seconds"] = wait_times[int(len(wait_times) * 0.99)]
+        return m
+
+
+_search_queue = _Queue("search", SEARCH_CONCURRENCY)
+_llm_queue = _Queue("LLM", LLM_CONCURRENCY)
+
+
+@contextmanager
+def search_slot(on_wait=None):
+    """Run a CPU-bound search (encoding and FAISS) once there's a free slot for it."""
+    with _search_queue.slot(on_wait=on_wait):
+        # Set for each search, since OpenMP's thread count applies to the calling thread.  torch's
+        # is process-wide, but every search sets it to the same share, so they don't conflict.
+        faiss.omp_set_num_threads(THREADS_PER_SEARCH)
+        if torch is not None:
+            torch.set_num_threads(THREADS_PER_SEARCH)
+        yield
+
+
+@contextmanager
+def llm_slot(on_wait=None):
+    """Run an LLM call once fewer than LLM_CONCURRENCY are in flight."""
+    with _llm_queue.slot(on_wait=on_wait):
+        yield
+
+
+def get_metrics():
+    """Queue depth, running count and recent wait times for each queue."""
+    return {"search": _search_queue.metrics(), "llm": _llm_queue.metrics()}
@@ -1,7 +1,10 @@
-from collections import defaultdict
+from collections import Counter, defaultdict, OrderedDict
 import json
 import os
 import re
+import threading
+import time
+import uuid
 
 import numpy as np
 import pandas as pd
@@ -138,29 +141,231 @@ def load_data(use_local_embeddings=True, corpus="all"):
         for line in fs:
             x = json.loads(line)
             convs[x["id"]] = x
-    return {
+    data = {
         "faiss_index": faiss_index,
         "conversations": convs,
         "docs": docs,
         "speaker_intros": speaker_intros,
     }
+    conversation_index = vectorize.get_conversation_index(
+        use_local_embeddings=use_local_embeddings, corpus=corpus
+    )
+    if conversation_index is not None:
+        (
+            data["conversation_index"],
+            data["conversation_rows"],
+            data["conversation_snippets"],
+        ) = conversation_index
+        # How many rows of the conversation index the most split-up conversation takes
+        data["max_conversation_centroids"] = max(
+            Counter(data["conversation_rows"]).values(), default=1
+        )
+    return data
 
 
-def run_query(user_input, data, encode, input_scope, corpus):
+# Server-side cache of candidate lists for paging through search results: how many searches
+# to keep, for how long (in seconds) since last use, and how many pages to fetch up front
+SEARCH_CACHE_SIZE = 256
+SEARCH_CACHE_TTL = 30 * 60
+SEARCH_OVERFETCH = 4
+_search_cache = OrderedDict()  # cursor key -> cached search
+_search_cache_lock = threading.Lock()
+
+# How many conversations to search in conversation-first mode
+CONVERSATION_SEARCH_SIZE = 20
+
+# How many rows to hydrate and write at a time when exporting
+EXPORT_PAGE_SIZE = 1000
+EXPORT_FORMATS = ["csv", "jsonl", "parquet"]
+# Nullable pandas dtypes for each kind of export column
+EXPORT_DTYPES = {
+    "bool": "boolean",
+    "int64": "Int64",
+    "float64": "Float64",
+    "string": "string",
+}
+
+
+def encode_query(user_input, encode):
     embedding = encode([user_input])
     query_vec = np.zeros((1, embedding.shape[1])).astype("float32")
     query_vec[0] = embedding
+    return query_vec
+
+
+def num_results_for_scope(input_scope):
     if input_scope.startswith("top_"):
-        num_results = int(input_scope.split("_")[1])
-    else:
-        num_results = 100
+        return int(input_scope.split("_")[1])
+    return 100
+
+
+def run_query(user_input, data, encode, input_scope, corpus):
+    query_vec = encode_query(user_input, encode)
+    num_results = num_results_for_scope(input_scope)
     distances, items = data["faiss_index"].search(query_vec, num_results)
+    similarities = vectorize.distance_to_similarity(data["faiss_index"], distances[0])
+    return hydrate_results(items[0], data, input_scope, corpus, similarities)
+
+
+def _search_cache_get(key):
+    """Look up a cached search, dropping expired and least recently used entries as we go."""
+    now = time.time()
+    with _search_cache_lock:
+        expired = [
+            k for k, e in _search_cache.items() if now - e["last_used"] > SEARCH_CACHE_TTL
+        ]
+        for k in expired:
+            del _search_cache[k]
+        entry = _search_cache.get(key)
+        if entry is not None:
+            entry["last_used"] = now
+            _search_cache.move_to_end(key)
+        return entry
+
+
+def _search_cache_put(entry):
+    key = uuid.uuid4().hex
+    entry["last_used"] = time.time()
+    with _search_cache_lock:
+        _search_cache[key] = entry
+        while len(_search_cache) > SEARCH_CACHE_SIZE:
+            _search_cache.popitem(last=False)
+    return key
+
+
+def _deepen_search(entry, data, depth):
+    """Re-run the cached query with a larger k, reusing its query vector."""
+    faiss_index = data["faiss_index"]
+    depth = min(depth, faiss_index.ntotal)
+    distances, items = faiss_index.search(entry["query_vec"], depth)
+    found = items[0] >= 0
+    entry["ids"] = items[0][found]
+    entry["distances"] = distances[0][found]
+    entry["exhausted"] = depth >= faiss_index.ntotal or not found.all()
+
+
+def run_paged_query(user_input, data, encode, input_scope, corpus, page_size=None):
+    """Like run_query, but over-fetches and caches the candidate list for later pages.
+
+    Returns the first page of results and a cursor for fetch_next_page (None if there are no more).
+    """
+    page_size = page_size or num_results_for_scope(input_scope)
+    entry = {
+        "query_vec": encode_query(user_input, encode),
+        "corpus": corpus,
+        "input_scope": input_scope,
+        "page_size": page_size,
+    }
+    _deepen_search(entry, data, page_size * SEARCH_OVERFETCH)
+    return _fetch_page(_search_cache_put(entry), entry, 0, data)
+
+
+def fetch_next_page(cursor, data):
+    """Return the next page of results and the cursor after it, or None if the search has expired.
+
+    Only this page's results are hydrated; the search is re-run deeper only when the cached
+    candidate list runs out.
+    """
+    key, offset = cursor.rsplit(":", 1)
+    entry = _search_cache_get(key)
+    if entry is None:
+        return None
+    return _fetch_page(key, entry, int(offset), data)
+
+
+def _fetch_page(key, entry, offset, data):
+    end = offset + entry["page_size"]
+    if end > len(entry["ids"]) and not entry["exhausted"]:
+        _deepen_search(entry, data, max(end, len(entry["ids"]) * 2))
+    results = hydrate_results(
+        entry["ids"][offset:end],
+        data,
+        entry["input_scope"],
+        entry["corpus"],
+        vectorize.distance_to_similarity(
+            data["faiss_index"], entry["distances"][offset:end]
+        ),
+        start=offset,
+    )
+    if end < len(entry["ids"]) or not entry["exhausted"]:
+        cursor = "%s:%d" % (key, end)
+    else:
+        cursor = None
+    return results, cursor
+
+
+def find_conversations(query_vec, data, num_conversations=CONVERSATION_SEARCH_SIZE):
+    """Return [(conversation_id, similarity)] for the conversations closest to the query, best first."""
+    query_vec = query_vec / np.linalg.norm(query_vec, axis=1, keepdims=True)
+    conversation_index = data["conversation_index"]
+    # A conversation may have several centroids, so over-fetch enough that num_conversations
+    # distinct ones come back even if the top conversations use all their centroids
+    k = min(
+        num_conversations * data["max_conversation_centroids"],
+        conversation_index.ntotal,
+    )
+    similarities, rows = conversation_index.search(query_vec, k)
+    conversations = []
+    seen = set()
+    for similarity, row in zip(similarities[0], rows[0]):
+        if row < 0:
+            continue
+        conversation_id = data["conversation_rows"][row]
+        if conversation_id in seen:
+            continue
+        seen.add(conversation_id)
+        conversations.append((conversation_id, float(similarity)))
+        if len(conversations) == num_conversations:
+            break
+    return conversations
+
+
+def run_conversation_query(
+    user_input,
+    data,
+    encode,
+    input_scope,
+    corpus,
+    num_conversations=CONVERSATION_SEARCH_SIZE,
+):
+    """Like run_query, but only searches the snippets of the conversations closest to the query.
+
+    The snippets of those conversations are scored exactly against their stored vectors, so the
+    cost depends on the size of the chosen conversations rather than of the whole corpus.
+    Returns the results and the chosen conversations (as from find_conversations).
+    """
+    query_vec = encode_query(user_input, encode)
+    conversations = find_conversations(query_vec, data, num_conversations)
+    ids = np.concatenate(
+        [
+            np.arange(start, end, dtype="int64")
+            for conversation_id, _ in conversations
+            for start, end in data["conversation_snippets"][conversation_id]
+        ]
+        or [np.zeros(0, dtype="int64")]
+    )
+    if len(ids) == 0:
+        return [], conversations
+    query_vec = query_vec / np.linalg.norm(query_vec, axis=1, keepdims=True)
+    similarities = vectorize.get_vectors(data["faiss_index"], ids) @ query_vec[0]
+    num_results = num_results_for_scope(input_scope)
+    top = np.argsort(-similarities, kind="stable")[:num_results]
+    results = hydrate_results(ids[top], data, input_scope, corpus, similarities[top])
+    return results, conversations
+
+
+def hydrate_results(items, data, input_scope, corpus, similarities, start=0):
+    """Turn snippet indexes returned by a search into result dicts, numbered from start + 1.
+
+    similarities gives each item's cosine similarity to the query, which is kept on the result.
+    """
     results = []
-    for i, res_idx in enumerate(items[0]):
+    for i, (res_idx, similarity) in enumerate(zip(items, similarities)):
         if res_idx < 0:
             continue
         res = dict(data["docs"][res_idx])
-        res["res_idx"] = i + 1
+        res["res_idx"] = start + i + 1
+        res["similarity"] = float(similarity)
         if "with_bio" in input_scope:
             res["speaker_intro"] = " ".join(
                 data["speaker_intros"].get(
@@ -189,16 +394,109 @@ def run_query(user_input, data, encode, input_scope, corpus):
     return results
 
 
+def diversify_results(
+    results,
+    data,
+    duplicate_threshold=0.92,
+    mmr_lambda=0.7,
+    max_per_conversation=5,
+):
+    """Collapse near-duplicate results and reorder the rest by maximal marginal relevance.
+
+    Results whose stored vectors are within duplicate_threshold (cosine) of a higher-ranked
+    result are attached to it under "duplicates".  Results left over once their conversation
+    has max_per_conversation results are attached under "more_from_conversation" to that
+    conversation's best result.  Relevance for MMR is each result's similarity to the query.
+    """
+    if len(results) < 2:
+        return results
+    vectors = vectorize.get_vectors(
+        data["faiss_index"], [r["snippet_index"] for r in results]
+    )
+    sims = vectors @ vectors.T
+    n = len(results)
+
+    # Greedy collapse in rank order: each result joins the first kept result it duplicates
+    rep_of = np.arange(n)
+    kept = np.zeros(n, dtype=bool)
+    for i in range(n):
+        dup = kept & (sims[i] >= duplicate_threshold)
+        if dup.any():
+            rep_of[i] = np.argmax(dup)
+        else:
+            kept[i] = True
+    reps = np.flatnonzero(kept)
+
+    # MMR over the remaining representatives, honoring the per-conversation cap
+    relevance = np.array([r["similarity"] for r in results])[reps]
+    rep_sims = sims[np.ix_(reps, reps)]
+    conv_ids = np.array([results[i]["conversation_id"] for i in reps], dtype=object)
+    conv_counts = defaultdict(lambda: 0)
+    available = np.ones(len(reps), dtype=bool)
+    max_sim = np.zeros(len(reps))
+    selected = []
+    while available.any():
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * max_sim
+        scores[~available] = -np.inf
+        j = int(np.argmax(scores))
+        selected.append(j)
+        available[j] = False
+        max_sim = np.maximum(max_sim, rep_sims[j])
+        conv_counts[conv_ids[j]] += 1
+        if max_per_conversation and conv_counts[conv_ids[j]] >= max_per_conversation:
+            available &= conv_ids != conv_ids[j]
+
+    diversified = {}
+    best_in_conversation = {}
+    for j in selected:
+        i = reps[j]
+        res = dict(results[i])
+        res["duplicates"] = [
+            results[k] for k in range(n) if not kept[k] and rep_of[k] == i
+        ]
+        res["more_from_conversation"] = []
+        diversified[i] = res
+        best_in_conversation.setdefault(res["conversation_id"], res)
+    # Representatives cut by the cap go (with their own duplicates) under their conversation's best
+    for i in reps:
+        if i not in diversified:
+            best = best_in_conversation[results[i]["conversation_id"]]
+            best["more_from_conversation"].append(results[i])
+            best["more_from_conversation"].extend(
+                results[k] for k in range(n) if not kept[k] and rep_of[k] == i
+            )
+    return list(diversified.values())
+
+
+def _collapsed_note(res):
+    """Tell the LLM how many remarks were folded into this one by diversify_results."""
+    notes = []
+    if res.get("duplicates"):
+        notes.append("said %d more times in similar words" % (len(res["duplicates"])))
+    if res.get("more_from_conversation"):
+        notes.append(
+            "%d more remarks from this conversation not shown"
+            % (len(res["more_from_conversation"]))
+        )
+    return notes and " (%s)" % ("; ".join(notes)) or ""
+
+
 def run_rag_query(user_input, results, model, input_scope):
     if "with_bio" in input_scope:
         examples = [
-            '- [%s] "%s" (from %s, whose first remarks were: "%s")'
-            % (r["res_idx"], r["content"], r["speaker_name"], r["speaker_intro"])
+            '- [%s] "%s" (from %s, whose first remarks were: "%s")%s'
+            % (
+                r["res_idx"],
+                r["content"],
+                r["speaker_name"],
+                r["speaker_intro"],
+                _collapsed_note(r),
+            )
             for r in results
         ]
     elif "with_context" in input_scope:
         examples = [
-            '- [%s] %s: "%s"\n%s: "%s"\n%s: "%s"'
+            '- [%s] %s: "%s"\n%s: "%s"\n%s: "%s"%s'
             % (
                 r["res_idx"],
                 r["prev_speaker_name"],
@@ -207,11 +505,15 @@ def run_rag_query(user_input, results, model, input_scope):
                 r["content"],
                 r["next_speaker_name"],
                 r["next_content"],
+                _collapsed_note(r),
             )
             for r in results
         ]
     else:
-        examples = ['- [%s] "%s"' % (r["res_idx"], r["content"]) for r in results]
+        examples = [
+            '- [%s] "%s"%s' % (r["res_idx"], r["content"], _collapsed_note(r))
+            for r in results
+        ]
     example_str = "\n".join(examples)
     prompt = (
         "Below are remarks from conversations, with an ID shown in brackets:\n\n###\n\n"
@@ -265,4 +567,156 @@ def analyze_citations(md, results, corpus=None):
 
 
 def convert_results_to_csv(results):
-    return pd.DataFrame(results).to_csv(index=False).encode("utf-8")
+    # Results folded in by diversify_results get their own rows, pointing back at where they went
+    rows = []
+    for res in results:
+        rows.append(
+            {
+                k: v
+                for k, v in res.items()
+                if k not in ("duplicates", "more_from_conversation")
+            }
+        )
+        for dup in res.get("duplicates", []):
+            rows.append(dict(dup, duplicate_of=res["res_idx"]))
+        for more in res.get("more_from_conversation", []):
+            rows.append(dict(more, more_from_conversation_of=res["res_idx"]))
+    return pd.DataFrame(rows).to_csv(index=False).encode("utf-8")
+
+
+def search_all(user_input, data, encode, min_similarity=None, max_results=None):
+    """Find every match at or above min_similarity (via a range search), or else the top max_results.
+
+    Only ids and similarities are returned, best first, so this stays small even for tens of
+    thousands of matches; use iter_export_rows to hydrate them.
+    """
+    query_vec = encode_query(user_input, encode)
+    faiss_index = data["faiss_index"]
+    if min_similarity is not None:
+        lims, distances, items = faiss_index.range_search(
+            query_vec, vectorize.similarity_to_distance(faiss_index, min_similarity)
+        )
+    else:
+        distances, items = faiss_index.search(query_vec, max_results or 100)
+        distances, items = distances[0], items[0]
+        distances, items = distances[items >= 0], items[items >= 0]
+    similarities = vectorize.distance_to_similarity(faiss_index, distances)
+    order = np.argsort(-similarities, kind="stable")
+    if max_results:
+        order = order[:max_results]
+    return items[order], similarities[order]
+
+
+def iter_export_rows(ids, similarities, data, page_size=EXPORT_PAGE_SIZE):
+    """Yield lists of result rows, joined with their conversation metadata, page_size at a time."""
+    for start in range(0, len(ids), page_size):
+        page = []
+        for i in range(start, min(start + page_size, len(ids))):
+            row = dict(data["docs"][int(ids[i])])
+            row["res_idx"] = i + 1
+            row["similarity"] = float(similarities[i])
+            conv_info = data["conversations"].get(row["conversation_id"], {})
+            for key, value in conv_info.items():
+                if key != "id" and not isinstance(value, (dict, list)):
+                    row["conversation_" + key] = value
+            page.append(row)
+        yield page
+
+
+def _column_kind(types):
+    """The export type for a column, given the Python types of its non-null values."""
+    if types and types <= {bool}:
+        return "bool"
+    if types and types <= {int}:
+        return "int64"
+    if types and types <= {int, float}:
+        return "float64"
+    return "string"
+
+
+def export_columns(data):
+    """Return [(name, kind)] for every column iter_export_rows can produce, from the whole corpus.
+
+    kind is one of EXPORT_DTYPES.  This scans every snippet and conversation once, and is kept on
+    data so later exports don't repeat it.
+    """
+    if "export_columns" not in data:
+        snippet_types = {}
+        for doc in data["docs"].values():
+            for key, value in doc.items():
+                types = snippet_types.setdefault(key, set())
+                if value is not None:
+                    types.add(type(value))
+        conversation_types = {}
+        for conv_info in data["conversations"].values():
+            for key, value in conv_info.items():
+                if key == "id" or isinstance(value, (dict, list)):
+                    continue
+                types = conversation_types.setdefault("conversation_" + key, set())
+                if value is not None:
+                    types.add(type(value))
+        columns = [(key, _column_kind(types)) for key, types in snippet_types.items()]
+        columns += [("res_idx", "int64"), ("similarity", "float64")]
+        columns += [
+            (key, _column_kind(types)) for key, types in conversation_types.items()
+        ]
+        data["export_columns"] = columns
+    return data["export_columns"]
+
+
+def _export_value(value, kind):
+    if kind == "string" and value is not None and not isinstance(value, str):
+        return json.dumps(value)
+    return value
+
+
+def write_export(pages, fs, columns, fmt="csv"):
+    """Write pages of rows to the binary file fs as they arrive, returning the number of rows.
+
+    columns, from export_columns, fixes the columns and their types up front, so every page is
+    written the same way whichever fields its rows happen to have.  For Parquet, each page becomes
+    its own row group.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format: %s" % (fmt))
+    names = [name for name, _ in columns]
+    dtypes = {name: EXPORT_DTYPES[kind] for name, kind in columns}
+
+    writer = None
+    if fmt == "csv":
+        fs.write(pd.DataFrame(columns=names).to_csv(index=False).encode("utf-8"))
+    elif fmt == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema(
+            [
+                pa.field(name, pa.type_for_alias(kind), nullable=True)
+                for name, kind in columns
+            ]
+        )
+        writer = pq.ParquetWriter(fs, schema)
+
+    num_rows = 0
+    for page in pages:
+        if not page:
+            continue
+        df = pd.DataFrame(
+            [
+                {name: _export_value(row.get(name), kind) for name, kind in columns}
+                for row in page
+            ],
+            columns=names,
+        ).astype(dtypes)
+        if fmt == "csv":
+            fs.write(df.to_csv(index=False, header=False).encode("utf-8"))
+        elif fmt == "jsonl":
+            fs.write(df.to_json(orient="records", lines=True).encode("utf-8"))
+        else:
+            writer.write_table(
+                pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+            )
+        num_rows += len(df)
+    if writer is not None:
+        writer.close()
+    return num_rows
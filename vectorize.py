@@ -12,9 +12,17 @@ from openai import OpenAI
 import os
 import re
 import sys
+import threading
 import util
 
 BATCH_SIZE = 1024
+# For out-of-core index builds: vectors added per shard, and vectors sampled for training
+INDEX_CHUNK_SIZE = 100000
+TRAIN_SAMPLE_SIZE = 100000
+# FAISS wants at least 39 training points per coarse centroid; give it some headroom
+TRAIN_POINTS_PER_CENTROID = 64
+# Below this many snippets per centroid, a conversation isn't split into k-means centroids
+MIN_POINTS_PER_CENTROID = 39
 LOCAL_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
 OPENAI_EMBEDDING_MODEL = "text-embedding-3-small"
 
@@ -23,6 +31,7 @@ EMBEDDINGS_FILE = "snippets_with_embeddings.jsonl"
 from sentence_transformers import SentenceTransformer
 
 openai_client = OpenAI()
+_direct_map_lock = threading.Lock()
 
 
 def chunks(reader, n):
@@ -73,6 +82,186 @@ def index_data(use_local_embeddings, corpus="all"):
     faiss.write_index(faiss_index, faiss_filename(use_local_embeddings, corpus))
 
 
+def index_data_out_of_core(
+    use_local_embeddings,
+    corpus="all",
+    chunk_size=INDEX_CHUNK_SIZE,
+    sample_size=TRAIN_SAMPLE_SIZE,
+):
+    """Like index_data, but for corpora whose vectors don't fit in memory.
+
+    The quantizer and PQ codebooks are trained on a reservoir sample (of at least sample_size
+    vectors, and enough for FAISS to train every coarse centroid), then the vectors are streamed
+    from disk chunk_size at a time into partial indexes, which are merged into on-disk inverted
+    lists.  Peak memory is roughly one chunk plus the training sample and codebooks.
+    """
+    from faiss.contrib.ondisk import merge_ondisk
+
+    corpus_dir = corpus_directory(corpus)
+    fname = os.path.join(corpus_dir, EMBEDDINGS_FILE)
+    index_fname = faiss_filename(use_local_embeddings, corpus)
+    rng = np.random.default_rng(0)
+
+    print("Counting vectors...")
+    total_rows = 0
+    with open(fname) as fs_in:
+        for line in fs_in:
+            total_rows += 1
+    nlist = int(math.sqrt(total_rows))
+    sample_size = min(
+        max(sample_size, TRAIN_POINTS_PER_CENTROID * nlist), total_rows
+    )
+
+    print("Sampling %s vectors for training..." % (sample_size))
+    num_rows = 0
+    sample = None
+    with open(fname) as fs_in:
+        for line in fs_in:
+            vector = json.loads(line)["embedding"]
+            if sample is None:
+                sample = np.zeros((sample_size, len(vector)), dtype="float32")
+            if num_rows < sample_size:
+                sample[num_rows] = vector
+            else:
+                j = rng.integers(0, num_rows + 1)
+                if j < sample_size:
+                    sample[j] = vector
+            num_rows += 1
+            if num_rows % chunk_size == 0:
+                print("Read %s of %s vectors." % (num_rows, total_rows))
+    vector_length = sample.shape[1]
+
+    print("Training on %s of %s vectors..." % (len(sample), num_rows))
+    quantizer = faiss.IndexFlatIP(vector_length)
+    faiss_index = faiss.IndexIVFPQ(
+        quantizer,
+        vector_length,
+        nlist,
+        vector_length // 2,  # (number of PQ segments)
+        4,
+    )
+    faiss_index.train(sample)
+    del sample
+    trained_fname = index_fname + ".trained"
+    faiss.write_index(faiss_index, trained_fname)
+
+    shard_fnames = []
+    entry_idx = 0
+    with open(fname) as fs_in:
+        for batch in chunks(fs_in, chunk_size):
+            rows = np.array(
+                [json.loads(line)["embedding"] for line in batch], dtype="float32"
+            )
+            ids = np.arange(entry_idx, entry_idx + len(rows), dtype="int64")
+            shard_index = faiss.read_index(trained_fname)
+            shard_index.add_with_ids(rows, ids)
+            shard_fname = "%s.shard_%04d" % (index_fname, len(shard_fnames))
+            faiss.write_index(shard_index, shard_fname)
+            shard_fnames.append(shard_fname)
+            entry_idx += len(rows)
+            del rows, shard_index
+            print("Added %s of %s vectors." % (entry_idx, num_rows))
+
+    print("Merging %s shards into on-disk inverted lists..." % (len(shard_fnames)))
+    faiss_index = faiss.read_index(trained_fname)
+    merge_ondisk(faiss_index, shard_fnames, index_fname + ".ivfdata")
+    faiss.write_index(faiss_index, index_fname)
+    for shard_fname in shard_fnames + [trained_fname]:
+        os.remove(shard_fname)
+
+
+def index_conversations(
+    use_local_embeddings, corpus="all", centroids_per_conversation=1
+):
+    """Build a small index of per-conversation vectors, for picking conversations before snippets.
+
+    Each conversation gets the mean of its snippet embeddings, or with centroids_per_conversation
+    > 1, that many k-means centroids (conversations too short to train them just get the mean).
+    Snippets are expected to be grouped by conversation.  Each row of the index is described by a
+    line in the file named by conversation_centroids_filename, giving its conversation and the
+    [start, end) snippet index ranges that conversation covers.
+    """
+    print("Building conversation index...")
+    corpus_dir = corpus_directory(corpus)
+    with open(os.path.join(corpus_dir, "conversations.jsonl")) as fs:
+        known_conversations = set(json.loads(line)["id"] for line in fs)
+
+    segments = []  # (conversation_id, start, end, centroids)
+    current_id = None
+    current_start = 0
+    current_vectors = []
+    last_index = None
+
+    def flush(end):
+        if current_id not in known_conversations or not current_vectors:
+            return
+        vectors = np.array(current_vectors, dtype="float32")
+        if (
+            centroids_per_conversation > 1
+            and len(vectors) >= MIN_POINTS_PER_CENTROID * centroids_per_conversation
+        ):
+            kmeans = faiss.Kmeans(
+                vectors.shape[1], centroids_per_conversation, niter=10, seed=0
+            )
+            kmeans.train(vectors)
+            centroids = kmeans.centroids
+        else:
+            centroids = vectors.mean(axis=0, keepdims=True)
+        segments.append((current_id, current_start, end, centroids))
+
+    with open(os.path.join(corpus_dir, EMBEDDINGS_FILE)) as fs_in:
+        for line in fs_in:
+            x = json.loads(line)
+            if x["conversation_id"] != current_id:
+                if current_id is not None:
+                    flush(last_index + 1)
+                current_id = x["conversation_id"]
+                current_start = x["snippet_index"]
+                current_vectors = []
+            current_vectors.append(x["embedding"])
+            last_index = x["snippet_index"]
+    if current_id is not None:
+        flush(last_index + 1)
+
+    ranges = {}
+    for conversation_id, start, end, _ in segments:
+        ranges.setdefault(conversation_id, []).append([start, end])
+    centroids = np.concatenate([c for _, _, _, c in segments]).astype("float32")
+    faiss.normalize_L2(centroids)
+    conversation_index = faiss.IndexFlatIP(centroids.shape[1])
+    conversation_index.add(centroids)
+    faiss.write_index(
+        conversation_index, conversation_faiss_filename(use_local_embeddings, corpus)
+    )
+    with open(
+        conversation_centroids_filename(use_local_embeddings, corpus), "w"
+    ) as fs_out:
+        for conversation_id, _, _, c in segments:
+            for _ in range(len(c)):
+                row = {
+                    "conversation_id": conversation_id,
+                    "snippet_ranges": ranges[conversation_id],
+                }
+                print(json.dumps(row), file=fs_out)
+    print(
+        "Indexed %s conversations with %s vectors." % (len(ranges), len(centroids))
+    )
+
+
+def conversation_faiss_filename(use_local_embeddings, corpus):
+    return os.path.join(
+        corpus_directory(corpus),
+        "fora_%s_conversations.faiss" % (use_local_embeddings and "local" or "openai"),
+    )
+
+
+def conversation_centroids_filename(use_local_embeddings, corpus):
+    return os.path.join(
+        corpus_directory(corpus),
+        "fora_%s_conversations.jsonl" % (use_local_embeddings and "local" or "openai"),
+    )
+
+
 def faiss_filename(use_local_embeddings, corpus):
     return os.path.join(
         corpus_directory(corpus),
@@ -104,11 +293,61 @@ def local_encode():
 
 def get_faiss_index(use_local_embeddings=True, corpus="all"):
     filename = faiss_filename(use_local_embeddings, corpus)
-    faiss_index = faiss.read_index(filename)
+    if os.path.exists(filename + ".ivfdata"):
+        # Built by index_data_out_of_core; inverted lists are memory-mapped from disk
+        faiss_index = faiss.read_index(filename, faiss.IO_FLAG_ONDISK_SAME_DIR)
+    else:
+        faiss_index = faiss.read_index(filename)
     faiss_index.nprobe = 50
     return faiss_index
 
 
+def get_conversation_index(use_local_embeddings=True, corpus="all"):
+    """Load the index built by index_conversations, or return None if there isn't one.
+
+    Returns the FAISS index, a list giving the conversation ID of each row, and a dict from
+    conversation ID to its [start, end) snippet index ranges.
+    """
+    filename = conversation_faiss_filename(use_local_embeddings, corpus)
+    if not os.path.exists(filename):
+        return None
+    row_conversations = []
+    snippet_ranges = {}
+    with open(conversation_centroids_filename(use_local_embeddings, corpus)) as fs:
+        for line in fs:
+            x = json.loads(line)
+            row_conversations.append(x["conversation_id"])
+            snippet_ranges[x["conversation_id"]] = x["snippet_ranges"]
+    return faiss.read_index(filename), row_conversations, snippet_ranges
+
+
+def get_vectors(faiss_index, ids):
+    """Return the (normalized) stored vectors for the given snippet indexes as an array."""
+    # Looking vectors up by snippet index needs a direct map, which is built on first use since it
+    # means reading every inverted list
+    with _direct_map_lock:
+        if faiss_index.direct_map.type == faiss.DirectMap.NoMap:
+            faiss_index.make_direct_map()
+    vectors = faiss_index.reconstruct_batch(np.asarray(ids, dtype="int64"))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def similarity_to_distance(faiss_index, similarity):
+    """Convert a cosine similarity into the index's native distance, assuming unit-length vectors."""
+    if faiss_index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        return similarity
+    return 2.0 - 2.0 * similarity  # squared L2
+
+
+def distance_to_similarity(faiss_index, distances):
+    """Inverse of similarity_to_distance, for an array of distances returned by FAISS."""
+    if faiss_index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        return distances
+    return 1.0 - distances / 2.0
+
+
 def get_encoder(use_local_embeddings=True):
     if use_local_embeddings:
         return local_encode()
@@ -134,9 +373,33 @@ def add_vectors(use_local_embeddings, corpus="all"):
 
 
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--out-of-core",
+        action="store_true",
+        help="Build the index from disk in chunks, for corpora that don't fit in memory",
+    )
+    parser.add_argument(
+        "--conversation-centroids",
+        type=int,
+        default=1,
+        help="Vectors per conversation in the conversation index (1 for the mean)",
+    )
+    args = parser.parse_args()
+
     use_local_embeddings = True
     util.init_corpora()
     for corpus in util.CORPORA:
         print("Processing", corpus)
         add_vectors(use_local_embeddings, corpus=corpus)
-        index_data(use_local_embeddings, corpus=corpus)
+        if args.out_of_core:
+            index_data_out_of_core(use_local_embeddings, corpus=corpus)
+        else:
+            index_data(use_local_embeddings, corpus=corpus)
+        index_conversations(
+            use_local_embeddings,
+            corpus=corpus,
+            centroids_per_conversation=args.conversation_centroids,
+        )